@@ -1,4 +1,5 @@
-import itertools
+import functools
+from collections import namedtuple
 
 import numpy as np
 import tensorflow as tf
@@ -21,65 +22,136 @@ from libspn_keras.layers.undecompose import Undecompose
 from libspn_keras.models import SpatialSumProductNetwork, DenseSumProductNetwork
 from libspn_keras.normalizationaxes import NormalizationAxes
 from tensorflow.keras import initializers
-from itertools import cycle
 
+_LEAF_CLS = {'normal': NormalLeaf, 'cauchy': CauchyLeaf, 'laplace': LaplaceLeaf}
 
-class ArchConfig:
 
-    def __init__(self, depthwise, num_non_overlapping, sum_num_channels, num_components,
-                 prod_num_channels, num_conv_sums):
-        self.depthwise = depthwise
-        self.num_non_overlapping = num_non_overlapping
-        self.sum_num_channels = sum_num_channels
-        self.num_components = num_components
-        self.prod_num_channels = prod_num_channels
-        self.num_conv_sums = num_conv_sums
+# Immutable so that a single (cached) instance can be shared by every call to
+# construct_dgcspn_model. Per-layer settings are either a single value that is used for all layers
+# or a tuple that is indexed per product/sum layer.
+ArchConfig = namedtuple("ArchConfig", [
+    "depthwise", "num_non_overlapping", "sum_num_channels", "num_components",
+    "prod_num_channels", "num_conv_sums"
+])
 
 
+@functools.lru_cache(maxsize=None)
 def get_config(name):
     if name == "olivetti":
         # This architecture was used in "Deep Generalized Convolutional Sum-Product Networks for
         # Probablistic Image Representations, Jos van de Wolfshaar, Andrzej Pronobis (2019)"
         return ArchConfig(
-            depthwise=iter([True, False, False, False, False, False, False]),
+            depthwise=(True, False, False, False, False, False, False),
             num_non_overlapping=0,
-            sum_num_channels=cycle([2]),
+            sum_num_channels=2,
             num_components=4,
-            prod_num_channels=cycle([None]),
+            prod_num_channels=None,
             num_conv_sums=2
         )
     if name == "mnist":
         return ArchConfig(
-            depthwise=iter([True, True, True, True, True, True]),
+            depthwise=True,
             num_non_overlapping=2,
-            sum_num_channels=cycle([8]),
+            sum_num_channels=8,
             num_components=8,
-            prod_num_channels=cycle([None]),
+            prod_num_channels=None,
             num_conv_sums=2
         )
     if name == "cifar10":
         return ArchConfig(
-            depthwise=iter([False, True, True, True, True, True]),
+            depthwise=(False, True, True, True, True, True),
             num_non_overlapping=1,
-            sum_num_channels=iter([32, 32, 64, 64, 64]),
+            sum_num_channels=(32, 32, 64, 64, 64),
             num_components=8,
-            prod_num_channels=cycle([None]),
+            prod_num_channels=None,
             num_conv_sums=2
         )
     else:
         raise ValueError("Unknown config")
 
 
+def _layer_setting(setting, index):
+    return setting[index] if isinstance(setting, tuple) else setting
+
+
+def _tensor_core_align(num_channels):
+    # Tensor core GEMMs require the number of channels to be a multiple of 8
+    return (num_channels + 7) // 8 * 8
+
+
+def _accumulator_initializer(logspace_accumulators, axis, weight_stddev, epsilon, seed=None):
+    if logspace_accumulators:
+        return tf.initializers.TruncatedNormal(mean=1.0, stddev=weight_stddev, seed=seed)
+    return EpsilonInverseFanIn(axis=axis, epsilon=epsilon)
+
+
+# A seeded initializer always draws the same weights, so each sum layer must be given its own
+# seed. The instance for a given seed is then shared by e.g. repeated model constructions
+_seeded_accumulator_initializer = functools.lru_cache(maxsize=None)(_accumulator_initializer)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_spec(
+    config_name, stack_size, dropout_rate, discriminative, return_weighted_child_logits,
+    tensor_core_align
+):
+    """Returns the sum-product stack of a DGC-SPN as a tuple of ``(layer_class, layer_kwargs)``
+    pairs, where ``layer_kwargs`` is a tuple of ``(name, value)`` items. Sum layers only hold
+    their structural arguments here, their accumulator arguments are added at instantiation.
+    The spec is cached, so it must be treated as read-only."""
+    config = get_config(config_name)
+    num_sum_layers = config.num_non_overlapping + stack_size
+    spec = []
+
+    # The 'backbone' stack of alternating sums and products. The first num_non_overlapping
+    # products use non-overlapping patches, the remaining products use exponentially increasing
+    # dilation rates
+    for i in range(num_sum_layers):
+        if i < config.num_non_overlapping:
+            product_kwargs = dict(strides=[2, 2], dilations=[1, 1], padding='valid')
+        else:
+            dilation = 2 ** (i - config.num_non_overlapping)
+            product_kwargs = dict(strides=[1, 1], dilations=[dilation, dilation], padding='full')
+        spec.append((Conv2DProduct, dict(
+            kernel_size=[2, 2], depthwise=_layer_setting(config.depthwise, i),
+            num_channels=_layer_setting(config.prod_num_channels, i),
+            **product_kwargs
+        )))
+        if dropout_rate is not None:
+            spec.append((LogDropout, dict(rate=dropout_rate)))
+
+        sum_type = Conv2DSum if i < config.num_conv_sums else Local2DSum
+        num_sums = _layer_setting(config.sum_num_channels, i)
+        if tensor_core_align:
+            num_sums = _tensor_core_align(num_sums)
+        spec.append((sum_type, dict(num_sums=num_sums)))
+
+    spec.append((Conv2DProduct, dict(
+        strides=[1, 1], dilations=[2 ** stack_size, 2 ** stack_size], kernel_size=[2, 2],
+        padding='final', depthwise=_layer_setting(config.depthwise, num_sum_layers),
+        num_channels=_layer_setting(config.prod_num_channels, num_sum_layers)
+    )))
+    spec.append((SpatialToRegions, dict()))
+
+    if discriminative:
+        spec.append((DenseSum, dict(num_sums=10)))
+
+    spec.append((RootSum, dict(
+        return_weighted_child_logits=return_weighted_child_logits,
+        dimension_permutation=DimensionPermutation.REGIONS
+    )))
+    return tuple((layer_cls, tuple(layer_kwargs.items())) for layer_cls, layer_kwargs in spec)
+
+
 def construct_dgcspn_model(
     input_shape, logspace_accumulators, backprop_mode, return_weighted_child_logits,
     completion_by_posterior_marginal=False, initialization_data=None,
     location_trainable=False, weight_stddev=0.1, discriminative=False,
     dropout_rate=None, cdf_rate=None, input_dropout_rate=None, accumulator_init_epsilon=1e-4,
     config_name='olivetti', normalization_epsilon=1e-8, accumulator_regularizer=None,
-    with_evidence_mask=False, leaf_type=None
+    with_evidence_mask=False, leaf_type='normal', seed=None,
+    tensor_core_align=False
 ):
-    sum_product_stack = []
-
     spatial_dims = int(np.sqrt(np.prod(input_shape[0:2])))
 
     if initialization_data is not None:
@@ -95,84 +167,47 @@ def construct_dgcspn_model(
         location_initializer = Equidistant(minval=-2.0, maxval=2.0)
 
     config = get_config(config_name)
-    leaf = dict(normal=NormalLeaf, cauchy=CauchyLeaf, laplace=LaplaceLeaf)[leaf_type](
+    leaf = _LEAF_CLS[leaf_type](
         num_components=config.num_components, location_initializer=location_initializer,
         location_trainable=location_trainable, use_accumulators=False,
         dimension_permutation=DimensionPermutation.SPATIAL
     )
-    accumulator_initializer = (
-        tf.initializers.TruncatedNormal(mean=1.0, stddev=weight_stddev)
-        if logspace_accumulators
-        else EpsilonInverseFanIn(axis=2, epsilon=accumulator_init_epsilon)
-    )
     sum_kwargs = dict(
         logspace_accumulators=logspace_accumulators,
-        accumulator_initializer=accumulator_initializer,
         backprop_mode=backprop_mode,
         accumulator_regularizer=accumulator_regularizer
     )
 
-    sum_type_iter = itertools.chain(
-        iter([Conv2DSum] * config.num_conv_sums), itertools.cycle([Local2DSum]))
-
-    # The 'backbone' stack of alternating sums and products
-    for _ in range(config.num_non_overlapping):
-        sum_product_stack.append(
-            Conv2DProduct(
-                strides=[2, 2], dilations=[1, 1], kernel_size=[2, 2], padding='valid',
-                depthwise=next(config.depthwise), num_channels=next(config.prod_num_channels)
-            )
-        )
-        if dropout_rate is not None:
-            sum_product_stack.append(LogDropout(rate=dropout_rate))
-
-        sum_product_stack.append(
-            next(sum_type_iter)(num_sums=next(config.sum_num_channels), **sum_kwargs)
-        )
-
-    stack_size = int(np.ceil(np.log2(spatial_dims // 2 ** config.num_non_overlapping)))
-    for i in range(stack_size):
-        sum_product_stack.append(
-            Conv2DProduct(
-                strides=[1, 1], dilations=[2 ** i, 2 ** i], kernel_size=[2, 2], padding='full',
-                depthwise=next(config.depthwise), num_channels=next(config.prod_num_channels)
-            ),
-        )
-
-        if dropout_rate is not None:
-            sum_product_stack.append(LogDropout(rate=dropout_rate))
-
-        sum_product_stack.append(
-            next(sum_type_iter)(num_sums=next(config.sum_num_channels), **sum_kwargs)
-        )
-
-    sum_product_stack.append(
-        Conv2DProduct(
-            strides=[1, 1], dilations=[2 ** stack_size, 2 ** stack_size], kernel_size=[2, 2],
-            padding='final', depthwise=next(config.depthwise),
-            num_channels=next(config.prod_num_channels)
-        )
+    # Number of dilated products needed to cover the remaining spatial extent, i.e.
+    # ceil(log2(n)) computed exactly on integers
+    stack_size = ((spatial_dims >> config.num_non_overlapping) - 1).bit_length()
+    # Channels are only aligned for log-space accumulators, i.e. for gradient based training
+    spec = _build_spec(
+        config_name, stack_size, dropout_rate, discriminative, return_weighted_child_logits,
+        tensor_core_align=tensor_core_align and logspace_accumulators
     )
-    if dropout_rate is not None:
-        LogDropout(rate=dropout_rate),
-
-    sum_product_stack.extend([
-        SpatialToRegions()
-    ])
-
-    if discriminative:
-        sum_product_stack.append(DenseSum(num_sums=10, **sum_kwargs))
 
-    accumulator_initializer = (
-        tf.initializers.TruncatedNormal(mean=1.0, stddev=weight_stddev)
-        if logspace_accumulators
-        else EpsilonInverseFanIn(axis=0, epsilon=accumulator_init_epsilon)
-    )
-    sum_kwargs['accumulator_initializer'] = accumulator_initializer
-    sum_product_stack.append(
-        RootSum(return_weighted_child_logits=return_weighted_child_logits,
-                dimension_permutation=DimensionPermutation.REGIONS, **sum_kwargs)
-    )
+    sum_product_stack = []
+    num_sum_layers = 0
+    for layer_cls, layer_kwargs in spec:
+        layer_kwargs = dict(layer_kwargs)
+        if layer_cls in (Conv2DSum, Local2DSum, DenseSum, RootSum):
+            initializer_args = (
+                logspace_accumulators, 0 if layer_cls is RootSum else 2, weight_stddev,
+                accumulator_init_epsilon
+            )
+            if seed is None:
+                # A reused unseeded initializer repeats its values for equal shapes, so every sum
+                # layer gets its own instance
+                accumulator_initializer = _accumulator_initializer(*initializer_args)
+            else:
+                # Offset the seed per sum layer, so that layers with equal accumulator shapes are
+                # initialized differently
+                accumulator_initializer = _seeded_accumulator_initializer(
+                    *initializer_args, seed + num_sum_layers)
+            layer_kwargs.update(sum_kwargs, accumulator_initializer=accumulator_initializer)
+            num_sum_layers += 1
+        sum_product_stack.append(layer_cls(**layer_kwargs))
 
     return SpatialSumProductNetwork(
         leaf=leaf,
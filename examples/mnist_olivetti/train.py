@@ -1,4 +1,5 @@
 import argparse
+import functools
 
 import skimage.io as skio
 import tensorflow as tf
@@ -16,6 +17,9 @@ import numpy as np
 def main():
     if args.eager:
         tf.config.experimental_run_functions_eagerly(True)
+    elif not args.no_xla:
+        # Lets XLA cluster and fuse the elementwise log-space ops of the sum-product stack
+        tf.config.optimizer.set_jit(True)
 
     gpus = tf.config.experimental.list_physical_devices('GPU')
     if gpus:
@@ -29,61 +33,77 @@ def main():
             # Memory growth must be set before GPUs have been initialized
             print(e)
 
+    if hasattr(tf.config.experimental, 'enable_tensor_float_32_execution'):
+        # As of TF 2.4, this lets the convolutions and matmuls of the sum layers use TensorFloat-32
+        # on GPUs with compute capability 8.0 or higher, other devices are unaffected
+        tf.config.experimental.enable_tensor_float_32_execution(args.tf32)
+
+    if args.multi_gpu:
+        # Replicates the SPN over all visible GPUs and sums the gradients with NCCL all-reduce
+        strategy = tf.distribute.MirroredStrategy(
+            cross_device_ops=tf.distribute.NcclAllReduce())
+    else:
+        strategy = tf.distribute.get_strategy()
+
     accumulator_regularizer = keras.regularizers.l1_l2(l1=args.l1, l2=args.l2)
+    # The optimizer and metrics create variables, so they are only constructed inside the scope of
+    # the distribution strategy
     if args.mode == "generative-hard-em":
         logspace_accumulators = False
         backprop_mode = BackpropMode.HARD_EM
         loss = NegativeLogMarginal(name="NegativeLogMarginal")
-        metrics = [LogMarginalLikelihood(name="LogMarginal")]
-        optimizer = tf.keras.optimizers.SGD(lr=args.lr)
+        make_metrics = [functools.partial(LogMarginalLikelihood, name="LogMarginal")]
+        make_optimizer = functools.partial(tf.keras.optimizers.SGD, lr=args.lr)
         return_weighted_child_logits = False
     elif args.mode == "generative-hard-em-unweighted":
         logspace_accumulators = False
         backprop_mode = BackpropMode.HARD_EM_UNWEIGHTED
         loss = NegativeLogMarginal(name="NegativeLogMarginal")
-        metrics = [LogMarginalLikelihood(name="LogMarginal")]
-        optimizer = tf.keras.optimizers.SGD(lr=args.lr)
+        make_metrics = [functools.partial(LogMarginalLikelihood, name="LogMarginal")]
+        make_optimizer = functools.partial(tf.keras.optimizers.SGD, lr=args.lr)
         return_weighted_child_logits = False
     elif args.mode == "generative-soft-em":
         logspace_accumulators = False
         backprop_mode = BackpropMode.EM
         loss = NegativeLogMarginal(name="NegativeLogMarginal")
-        metrics = [LogMarginalLikelihood(name="LogMarginal")]
-        optimizer = tf.keras.optimizers.SGD(lr=args.lr)
+        make_metrics = [functools.partial(LogMarginalLikelihood, name="LogMarginal")]
+        make_optimizer = functools.partial(tf.keras.optimizers.SGD, lr=args.lr)
         return_weighted_child_logits = False
     elif args.mode == "generative-hard-em-supervised":
         logspace_accumulators = False
         backprop_mode = BackpropMode.HARD_EM
         loss = NegativeLogJoint()
-        metrics = [
-            LogMarginalLikelihood(name="LogMarginal"),
-            keras.metrics.SparseCategoricalAccuracy(name="Accuracy")
+        make_metrics = [
+            functools.partial(LogMarginalLikelihood, name="LogMarginal"),
+            functools.partial(keras.metrics.SparseCategoricalAccuracy, name="Accuracy")
         ]
-        optimizer = tf.keras.optimizers.SGD(lr=args.lr)
+        make_optimizer = functools.partial(tf.keras.optimizers.SGD, lr=args.lr)
         return_weighted_child_logits = True
     elif args.mode == "generative-hard-em-unweighted-supervised":
         logspace_accumulators = False
         backprop_mode = BackpropMode.HARD_EM_UNWEIGHTED
         loss = NegativeLogJoint()
-        metrics = [
-            LogMarginalLikelihood(name="LogMarginal"),
-            keras.metrics.SparseCategoricalAccuracy(name="Accuracy")
+        make_metrics = [
+            functools.partial(LogMarginalLikelihood, name="LogMarginal"),
+            functools.partial(keras.metrics.SparseCategoricalAccuracy, name="Accuracy")
         ]
-        optimizer = tf.keras.optimizers.SGD(lr=args.lr)
+        make_optimizer = functools.partial(tf.keras.optimizers.SGD, lr=args.lr)
         return_weighted_child_logits = True
     elif args.mode == "generative-gd":
         logspace_accumulators = True
         backprop_mode = BackpropMode.GRADIENT
         loss = NegativeLogMarginal(name="NegativeLogLikelihood")
-        metrics = [LogMarginalLikelihood(name="LogMarginal")]
-        optimizer = tf.keras.optimizers.Adam()
+        make_metrics = [functools.partial(LogMarginalLikelihood, name="LogMarginal")]
+        make_optimizer = tf.keras.optimizers.Adam
         return_weighted_child_logits = False
     elif args.mode == "discriminative-gd":
         logspace_accumulators = True
         backprop_mode = BackpropMode.GRADIENT
         loss = keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-        metrics = [keras.metrics.SparseCategoricalAccuracy(name="Accuracy")]
-        optimizer = tf.keras.optimizers.Adam(7e-3)
+        make_metrics = [
+            functools.partial(keras.metrics.SparseCategoricalAccuracy, name="Accuracy")
+        ]
+        make_optimizer = functools.partial(tf.keras.optimizers.Adam, 7e-3)
         return_weighted_child_logits = True
     else:
         raise ValueError("Unknown mode: {}".format(args.mode))
@@ -91,52 +111,63 @@ def main():
     x_train, y_train, x_test, y_test = load_data(
         spatial=args.model == 'dgcspn', dataset=args.dataset)
 
-    spn = construct_spn(accumulator_regularizer, backprop_mode, logspace_accumulators,
-                        return_weighted_child_logits, x_train, leaf=args.leaf)
+    # Batches are prefetched so that host-to-device copies overlap with the previous step
+    # Every replica gets a batch of args.batch_size samples
+    global_batch_size = args.batch_size * strategy.num_replicas_in_sync
+    train_data = make_dataset(x_train, y_train, global_batch_size, shuffle=True)
+    test_data = make_dataset(x_test, y_test, global_batch_size)
+
+    with strategy.scope():
+        spn = construct_spn(accumulator_regularizer, backprop_mode, logspace_accumulators,
+                            return_weighted_child_logits, x_train, leaf=args.leaf)
 
-    # Important to use from_logits=True with the cross-entropy loss
-    spn.compile(optimizer=optimizer, loss=loss,  metrics=metrics)
-    show_summary(spn, x_train)
-    spn.evaluate(x_test, y_test, verbose=2)
+        # Important to use from_logits=True with the cross-entropy loss
+        spn.compile(
+            optimizer=make_optimizer(), loss=loss, metrics=[make() for make in make_metrics])
+        # Building creates the weights, so it must happen in the scope to mirror them
+        show_summary(spn, x_train)
+    spn.evaluate(test_data, verbose=2)
 
     # Train
     # Note that y_train and y_test are effectively ignored if the learning mode is anything
     # different from 'discriminative-gd'
-    spn.fit(x_train, y_train, epochs=args.epochs, batch_size=args.batch_size)
-    spn.evaluate(x_test, y_test, verbose=2)
+    spn.fit(train_data, epochs=args.epochs)
+    spn.evaluate(test_data, verbose=2)
 
     if args.completion:
-        spn_for_completion = construct_spn(
-            accumulator_regularizer, BackpropMode.GRADIENT, logspace_accumulators,
-            return_weighted_child_logits, x_train, with_evidence_mask=True, completion=True,
-            leaf=args.leaf
-        )
-        spn_for_completion.compile(loss=loss)
-        if args.model == 'dgcspn':
-            spn_for_completion.predict([x_test[:1], np.ones(x_test[:1].shape[:-1] + (1,))])
-        else:
-            spn_for_completion.predict([x_test[:1], np.ones_like(x_test[:1])])
-
-        spn_for_completion.set_weights(spn.get_weights())
-
-        evaluate_completion(spn_for_completion, x_test)
+        # Temporarily switch the trained SPN to completion by posterior marginals
+        spn.completion_mode = True
+        evaluate_completion(spn, x_test, global_batch_size)
+        spn.completion_mode = False
     else:
         # Evaluate
-        spn.evaluate(x_test,  y_test, verbose=2)
+        spn.evaluate(test_data, verbose=2)
 
     spn.save_weights('spn.h5')
 
-    spn_loaded = construct_spn(
-        accumulator_regularizer, backprop_mode, logspace_accumulators,
-        return_weighted_child_logits, x_train
-    )
-    # Important to use from_logits=True with the cross-entropy loss
-    spn_loaded.compile(optimizer=optimizer, loss=loss, metrics=metrics)
-    show_summary(spn_loaded, x_train)
-    spn_loaded.load_weights('spn.h5')
+    with strategy.scope():
+        spn_loaded = construct_spn(
+            accumulator_regularizer, backprop_mode, logspace_accumulators,
+            return_weighted_child_logits, x_train, leaf=args.leaf
+        )
+        # Building traces the call once to create the weights to load into
+        spn_loaded.build(x_train.shape)
+        spn_loaded.load_weights('spn.h5')
+        # Important to use from_logits=True with the cross-entropy loss
+        spn_loaded.compile(
+            optimizer=make_optimizer(), loss=loss, metrics=[make() for make in make_metrics])
+    if args.verbose:
+        spn_loaded.summary()
 
     print("Evaluating model that was loaded from disk")
-    spn_loaded.evaluate(x_test, y_test, verbose=2)
+    spn_loaded.evaluate(test_data, verbose=2)
+
+
+def make_dataset(x, y, batch_size, shuffle=False):
+    dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shuffle:
+        dataset = dataset.shuffle(len(x))
+    return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
 
 
 def construct_spn(accumulator_regularizer, backprop_mode, logspace_accumulators,
@@ -161,80 +192,79 @@ def construct_spn(accumulator_regularizer, backprop_mode, logspace_accumulators,
             accumulator_init_epsilon=args.accumulator_init_epsilon,
             location_trainable=args.location_trainable,
             discriminative=args.mode == 'discriminative-gd',
-            with_evidence_mask=with_evidence_mask, leaf_type=leaf
+            with_evidence_mask=with_evidence_mask, leaf_type=leaf,
+            seed=args.seed, tensor_core_align=args.tc_align
         )
     return model
 
 
 def show_summary(model, x_train):
     model.build(x_train.shape)
-    model.call(keras.layers.Input(shape=x_train.shape[1:]))
     model.summary()
 
 
-def evaluate_completion(model_completion, x_test):
+def evaluate_completion(model_completion, x_test, batch_size):
     # Build masks
-    mask_bottom, mask_left, mask_right, mask_top = build_completion_masks(x_test)
-
-    kwargs = dict(verbose=2, batch_size=args.batch_size)
-    print("Bottom completion")
-    model_completion.evaluate([x_test, mask_bottom], x_test, **kwargs)
-    print("Left completion")
-    model_completion.evaluate([x_test, mask_left], x_test, **kwargs)
-    print("Right completion")
-    model_completion.evaluate([x_test, mask_right], x_test, **kwargs)
-    print("Top completion")
-    model_completion.evaluate([x_test, mask_top], x_test, **kwargs)
+    masks = build_completion_masks(x_test)
+    names = ["bottom", "left", "right", "top"]
+
+    # Complete for all masks in a single pass. The test set is streamed once per mask and each
+    # sample is paired with the single per-sample mask, so neither is stacked in memory
+    x_data = tf.data.Dataset.from_tensor_slices(x_test)
+    completion_data = functools.reduce(
+        tf.data.Dataset.concatenate,
+        [x_data.map(lambda x, mask=mask[0]: ((x, mask),)) for mask in masks]
+    ).batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+    num_masks = len(masks)
+    completions = model_completion.predict(completion_data).reshape(
+        (num_masks,) + x_test.shape)
+
+    for name, mask, completion in zip(names, masks, completions):
+        completed_only = np.logical_not(np.broadcast_to(mask, x_test.shape))
+        mse = np.mean(np.square(completion[completed_only] - x_test[completed_only]))
+        print("{} completion MSE: {:.4f}".format(name.capitalize(), mse))
 
     if args.model == 'dgcspn' and args.saveimg:
         print("Exporting completion images")
         im_grid = make_image_grid(x_test, num_rows=5)
         skio.imsave('test_data.png', arr=im_grid.astype(np.uint8))
 
-        kwargs = dict(batch_size=args.batch_size)
-
         ind = np.sort(np.random.choice(len(x_test), size=50, replace=False))
 
-        bottom_completion = model_completion.predict([x_test[ind], mask_bottom[ind]], **kwargs)
-        left_completion = model_completion.predict([x_test[ind], mask_left[ind]], **kwargs)
-        right_completion = model_completion.predict([x_test[ind], mask_right[ind]], **kwargs)
-        top_completion = model_completion.predict([x_test[ind], mask_top[ind]], **kwargs)
-
-        skio.imsave('comp_left.png', make_image_grid(left_completion, 5).astype(np.uint8))
-        skio.imsave('comp_right.png', make_image_grid(right_completion, 5).astype(np.uint8))
-        skio.imsave('comp_top.png', make_image_grid(top_completion, 5).astype(np.uint8))
-        skio.imsave('comp_bottom.png', make_image_grid(bottom_completion, 5).astype(np.uint8))
+        for name, completion in zip(names, completions):
+            skio.imsave(
+                'comp_{}.png'.format(name), make_image_grid(completion[ind], 5).astype(np.uint8))
 
 
 def build_completion_masks(x_test):
-
-    in_shape = x_test.shape
-    flatten_at_end = False
     if len(x_test.shape) == 3:
-        side = int(np.sqrt(x_test.shape[1]))
-        flatten_at_end = True
-        x_test = x_test.reshape(x_test.shape[0], side, side, x_test.shape[-1])
-
-    mask = np.ones(x_test.shape[:-1] + (1,)).astype(bool)
-    mask_left, mask_right, mask_top, mask_bottom = [mask.copy() for _ in range(4)]
-    mid = int(np.sqrt(np.prod(x_test.shape[1:3]))) // 2
-    mask_left[:, :, :mid, :] = False
-    mask_right[:, :, mid:, :] = False
-    mask_top[:, :mid, :, :] = False
-    mask_bottom[:, mid:, :, :] = False
-
-    if flatten_at_end:
-        s = in_shape[:-1] + (1,)
-        return mask_bottom.reshape(s), mask_left.reshape(s), \
-           mask_right.reshape(s), mask_top.reshape(s)
+        num_rows = num_cols = int(np.sqrt(x_test.shape[1]))
+    else:
+        num_rows, num_cols = x_test.shape[1:3]
+
+    # The masks are identical for all samples, so we only build a single [rows, cols] mask per
+    # completion and broadcast it to the batch without copying
+    row_indices, col_indices = np.indices((num_rows, num_cols))
+    mid = int(np.sqrt(num_rows * num_cols)) // 2
+    masks = [row_indices < mid, col_indices >= mid, col_indices < mid, row_indices >= mid]
+
+    mask_shape = x_test.shape[:-1] + (1,)
+    mask_bottom, mask_left, mask_right, mask_top = [
+        np.broadcast_to(mask.reshape((1,) + mask_shape[1:]), mask_shape) for mask in masks
+    ]
     return mask_bottom, mask_left, mask_right, mask_top
 
 
 def make_image_grid(images, num_rows):
-    images_per_row = np.split(images, axis=0, indices_or_sections=num_rows)
-    rows = [np.concatenate(imgs, axis=1) for imgs in images_per_row]
-    full_grid = np.concatenate(rows, axis=0)
-    return full_grid
+    num_images, height, width, num_channels = images.shape
+    num_cols = num_images // num_rows
+    grid = np.empty((num_rows * height, num_cols * width, num_channels), dtype=images.dtype)
+    # Write the tiles straight into the grid through a 5D view of it
+    np.copyto(
+        grid.reshape(num_rows, height, num_cols, width, num_channels),
+        images.reshape(num_rows, num_cols, height, width, num_channels).transpose(0, 2, 1, 3, 4)
+    )
+    return grid
 
 
 if __name__ == "__main__":
@@ -263,14 +293,22 @@ if __name__ == "__main__":
                         choices=['mnist', 'olivetti', 'cifar10'])
     parser.add_argument("--saveimg", action='store_true', dest='saveimg')
     parser.add_argument("--eager", action='store_true', dest='eager')
+    parser.add_argument("--no-xla", action='store_true', dest='no_xla')
     parser.add_argument("--normalization-epsilon", type=float, default=1e-8)
     parser.add_argument("--accumulator-init-epsilon", type=float, default=1e-8)
     parser.add_argument("--location-trainable", dest='location_trainable', action='store_true')
     parser.add_argument("--leaf", choices=['normal', 'cauchy', 'laplace'], default='normal')
     parser.add_argument("--lr", type=float, default=1e-2)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--no-tf32", action='store_false', dest='tf32')
+    parser.add_argument("--verbose", action='store_true', dest='verbose')
+    parser.add_argument("--tc-align", action='store_true', dest='tc_align')
+    parser.add_argument("--multi-gpu", action='store_true', dest='multi_gpu')
     parser.add_argument("--l2", type=float, default=0.0)
     parser.add_argument("--l1", type=float, default=0.0)
-    parser.set_defaults(completion=False, saveimg=False, eager=False, location_trainable=False)
+    parser.set_defaults(completion=False, saveimg=False, eager=False, location_trainable=False,
+                        no_xla=False, tf32=True, verbose=False,
+                        tc_align=False, multi_gpu=False)
     args = parser.parse_args()
     main()
 
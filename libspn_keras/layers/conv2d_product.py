@@ -23,8 +23,8 @@ class Conv2DProduct(keras.layers.Layer):
             usually requires non-overlapping patches, whilst full padding is used with
             overlapping patches and expontentially increasing dilation rates, see also
             [Van de Wolfshaar, Pronobis (2019)].
-        depthwise: Whether to use depthwise convolutions. If True, the value of num_channels
-            will be ignored
+        depthwise: Whether to use depthwise products. These are computed with a pooling kernel
+            instead of a convolution. If True, the value of num_channels will be ignored
         **kwargs: Keyword arguments to pass on to the keras.Layer superclass.
 
     References:
@@ -74,13 +74,11 @@ class Conv2DProduct(keras.layers.Layer):
         self._spatial_dim_sizes = num_scopes_vertical, num_scopes_horizontal
         self.num_channels = num_channels_in
 
-        sparse_kernels = self._create_sparse_kernels(1, 1)
-
-        onehot_kernels = self._sparse_kernels_to_onehot(sparse_kernels, 1)
-
+        # The pooling in _call_depthwise does not need a kernel, but this weight is kept so that
+        # weights saved with earlier versions of this layer can still be loaded
         self._onehot_kernels = self.add_weight(
-            "onehot_kernel", initializer=initializers.Constant(onehot_kernels), trainable=False,
-            shape=onehot_kernels.shape
+            "onehot_kernel", initializer=initializers.Ones(), trainable=False,
+            shape=tuple(self.kernel_size) + (1, 1)
         )
 
     def call(self, x):
@@ -96,30 +94,20 @@ class Conv2DProduct(keras.layers.Layer):
         x_padded = tf.pad(x, [[0, 0], [pad_top, pad_bottom], [pad_left, pad_right], [0, 0]])
         out = tf.nn.conv2d(
             x_padded, self._onehot_kernels, strides=self.strides, padding='VALID',
-            dilations=self.dilations
+            dilations=self.dilations, data_format='NHWC'
         )
         return out
 
     def _call_depthwise(self, x):
-        # Split in list of tensors which will be added up using outer products
+        # A depthwise product of log-space inputs is a sum per channel over each (dilated)
+        # patch, which is average pooling scaled by the kernel surface
         pad_left, pad_right, pad_top, pad_bottom = self._pad_sizes()
-        channels_first = tf.reshape(
-            tf.transpose(x, (0, 3, 1, 2)),
-            (-1,) + self._spatial_dim_sizes + (1,)
-        )
-        x_padded = tf.pad(
-            channels_first, [[0, 0], [pad_top, pad_bottom], [pad_left, pad_right], [0, 0]])
-        out = tf.nn.conv2d(
-            x_padded, self._onehot_kernels, strides=self.strides, padding='VALID',
-            dilations=self.dilations
-        )
-
-        spatial_dim_sizes_out = self._compute_out_size_spatial(*self._spatial_dim_sizes)
-
-        return tf.transpose(
-            tf.reshape(out, (-1, self.num_channels) + spatial_dim_sizes_out),
-            (0, 2, 3, 1)
+        x_padded = tf.pad(x, [[0, 0], [pad_top, pad_bottom], [pad_left, pad_right], [0, 0]])
+        out = tf.nn.pool(
+            x_padded, window_shape=self.kernel_size, pooling_type='AVG', strides=self.strides,
+            padding='VALID', dilations=self.dilations, data_format='NHWC'
         )
+        return out * float(np.prod(self.kernel_size))
 
     def compute_output_shape(self, input_shape):
         num_batch, num_scopes_vertical_in, num_scopes_horizontal_in, _ = input_shape
@@ -26,7 +26,7 @@ def logconv1x1_2d(input, filter):
     input -= input_max
 
     out = tf.math.log(tf.nn.convolution(
-        input=tf.exp(input), filters=tf.exp(filter), padding="SAME"))
+        input=tf.exp(input), filters=tf.exp(filter), padding="SAME", data_format="NHWC"))
     out += filter_max + input_max
 
     return out
@@ -11,4 +11,4 @@ def replace_infs_with_zeros(x):
         A `Tensor` with the same shape an dtype as `x` where infinite values are replaced
         with zeroes.
     """
-    return tf.where(tf.math.is_inf(x), tf.zeros_like(x), x)
\ No newline at end of file
+    return tf.where(tf.math.is_inf(x), tf.zeros([], dtype=x.dtype), x)
\ No newline at end of file
@@ -2,6 +2,8 @@ import abc
 import typing
 
 from tensorflow import keras
+
+from libspn_keras.backprop_mode import BackpropMode
 from libspn_keras.layers.bernoulli_condition import BernoulliCondition
 from libspn_keras.layers.dense_product import DenseProduct
 from libspn_keras.layers.base_leaf import BaseLeaf
@@ -57,17 +59,56 @@ class SumProductNetworkBase(keras.models.Model):
                 with_evidence_mask=with_evidence_mask, normalization_epsilon=normalization_epsilon)
         self.completion_by_posterior_marginal = completion_by_posterior_marginal
         self.sum_product_stack = sum_product_stack
-        self.evidence_mask = with_evidence_mask
+        self.evidence_mask = self._with_evidence_mask = with_evidence_mask
+        self._backprop_modes_before_completion = self._metrics_before_completion = None
         self.cdf_rate = cdf_rate
         self.input_dropout_rate = input_dropout_rate
         self.normalization_axes = normalization_axes
         self.normalization_epsilon = normalization_epsilon
         self.use_evidence_mask_for_normalization = with_evidence_mask_for_normalization
 
+    @property
+    def completion_mode(self):
+        """
+        Whether the SPN completes its input by posterior marginals. Setting this switches the
+        forward pass of an existing SPN, so that a trained SPN can be used for completion with
+        its current weights. In completion mode, the SPN expects an evidence mask as its second
+        input, its sum layers use ``BackpropMode.GRADIENT`` since posterior marginals are
+        computed from actual derivatives, and it reports a ``completion_mse`` metric.
+
+        Setting it back to False restores the evidence mask setting, the backprop modes of the
+        sum layers and the metrics the SPN had before entering completion mode. Any traced
+        train, test or predict functions are discarded on every switch.
+        """
+        return self.completion_by_posterior_marginal
+
+    @completion_mode.setter
+    def completion_mode(self, completion_mode):
+        self.completion_by_posterior_marginal = completion_mode
+        self.evidence_mask = completion_mode or self._with_evidence_mask
+        if self.normalization_axes is not None:
+            self.normalize.with_evidence_mask = self.evidence_mask
+
+        sum_layers = [layer for layer in self.sum_product_stack if hasattr(layer, 'backprop_mode')]
+        if completion_mode and self._backprop_modes_before_completion is None:
+            self._backprop_modes_before_completion = [layer.backprop_mode for layer in sum_layers]
+            for layer in sum_layers:
+                layer.backprop_mode = BackpropMode.GRADIENT
+            # The completion_mse metric is added by call, so it must be removed when leaving
+            self._metrics_before_completion = list(self._metrics)
+        elif not completion_mode and self._backprop_modes_before_completion is not None:
+            for layer, backprop_mode in zip(sum_layers, self._backprop_modes_before_completion):
+                layer.backprop_mode = backprop_mode
+            self._metrics[:] = self._metrics_before_completion
+            self._backprop_modes_before_completion = self._metrics_before_completion = None
+
+        # Functions that were traced by fit, evaluate or predict assume the previous forward pass
+        self.train_function = self.test_function = self.predict_function = None
+
     def _maybe_apply_evidence_mask(self, x, evidence_mask):
         if evidence_mask is None:
             return x
-        return tf.where(evidence_mask, x, tf.zeros_like(x))
+        return tf.where(evidence_mask, x, tf.zeros([], dtype=x.dtype))
 
     def _maybe_normalize_input(self, data_input, evidence_mask=None):
         if self.normalization_axes is None:
@@ -100,7 +141,8 @@ class SumProductNetworkBase(keras.models.Model):
     def _parse_inputs(self, inputs):
         require_evidence_mask = self.completion_by_posterior_marginal or self.evidence_mask
         evidence_mask_input = None
-        if isinstance(inputs, list):
+        # Inputs from a tf.data.Dataset are passed as a tuple rather than a list
+        if isinstance(inputs, (list, tuple)):
             if require_evidence_mask and len(inputs) != 2:
                 raise ValueError("Second input must be evidence mask")
             elif require_evidence_mask:
@@ -32,6 +32,8 @@ class RegionNode:
             must not overlap (pairwise disjoint)
     """
 
+    __slots__ = ('children', 'scope')
+
     def __init__(self, children):
         _assert_no_scope_overlap(children)
         self.children = children
@@ -50,6 +52,8 @@ class RegionVariable:
         index: Index of the variable
     """
 
+    __slots__ = ('index', 'scope')
+
     def __init__(self, index: int):
         self.index = index
         self.scope = [self]
@@ -132,8 +136,10 @@ def region_graph_to_dense_spn(
             **sum_kwargs
         ))
 
+    # Every variable occurs exactly once in the permutation, the remaining entries are padding
+    num_vars = int(np.count_nonzero(np.asarray(permutation) >= 0))
     pre_stack = [
-        FlatToRegions(num_decomps=1, input_shape=[len(_collect_variable_nodes(region_graph_root))]),
+        FlatToRegions(num_decomps=1, input_shape=[num_vars]),
         leaf_node,
         PermuteAndPadScopes(num_decomps=1, permutations=np.asarray([permutation]))
     ]
@@ -179,19 +185,6 @@ def _compute_max_num_children_by_depth(root, depth_to_nodes_mapping=None):
     return max_num_children_by_depth
 
 
-def _collect_variable_nodes(root):
-    variable_nodes = []
-
-    def _gather(node):
-        if isinstance(node, RegionVariable):
-            variable_nodes.append(node)
-        else:
-            [_gather(child) for child in node.children]
-
-    _gather(root)
-    return variable_nodes
-
-
 def _region_graph_to_permutations_and_prods_per_depth(root):
     node_to_depth_mapping = _get_nodes_to_depth_mapping(
         root
@@ -212,18 +205,19 @@ def _region_graph_to_permutations_and_prods_per_depth(root):
         depth = node_to_depth_mapping[node]
         if isinstance(node, RegionVariable) and depth < max_depth:
             permutations.append(node.index)
-            for _ in range(max_num_children_by_depth_cum_prod[max_depth]
-                           // max_num_children_by_depth_cum_prod[depth + 1]):
-                permutations.append(-1)
+            permutations.extend(
+                [-1] * (max_num_children_by_depth_cum_prod[max_depth]
+                        // max_num_children_by_depth_cum_prod[depth + 1]))
         elif isinstance(node, RegionVariable) and depth == max_depth:
             permutations.append(node.index)
         elif isinstance(node, RegionNode):
             [recurse_permutation(child) for child in node.children]
-            for _ in range(max_num_children_by_depth_cum_prod[depth] // max_num_children_by_depth_cum_prod[depth + 1] - len(node.children)):
-                children_beneath = \
-                    max_num_children_by_depth_cum_prod[max_depth] // \
-                    max_num_children_by_depth_cum_prod[depth + 1]
-                permutations.extend([-1] * children_beneath)
+            num_missing_children = max_num_children_by_depth_cum_prod[depth] // \
+                max_num_children_by_depth_cum_prod[depth + 1] - len(node.children)
+            children_beneath = \
+                max_num_children_by_depth_cum_prod[max_depth] // \
+                max_num_children_by_depth_cum_prod[depth + 1]
+            permutations.extend([-1] * (num_missing_children * children_beneath))
 
     recurse_permutation(root)
 